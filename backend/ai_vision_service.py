@@ -1,13 +1,24 @@
 import aiohttp
 import asyncio
 import base64
-import json
-from typing import Dict, Any
+import orjson
+import os
+import random
+import xxhash
+from typing import Any, Dict, List, Tuple
+from urllib.parse import parse_qs, urlsplit
 
-async def get_ai_visual_analysis(session: aiohttp.ClientSession, image_bytes: bytes, vision_api_url: str) -> Dict[str, Any]:
-    """Gets a structured JSON analysis with rate limit handling."""
-    headers = {"Content-Type": "application/json"}
-    prompt = """Analyze the image in extreme detail. First, classify it as "substantive" (e.g., a photograph, chart, diagram, table, document scan) or "decorative" (e.g., a simple icon, logo, border, ornamental graphic).
+GEMINI_UPLOAD_URL = "https://generativelanguage.googleapis.com/upload/v1beta/files"
+
+# Cap in-flight Gemini requests so bursts don't open hundreds of sockets
+# and immediately trip the rate limiter.
+VISION_SEMAPHORE = asyncio.Semaphore(int(os.getenv("GEMINI_CONCURRENCY", "6")))
+
+# Built once: the ~2 KB analysis prompt and generation config never change,
+# so each request only has to splice in its image part.
+_GENERATION_CONFIG = {"responseMimeType": "application/json"}
+
+VISION_PROMPT = """Analyze the image in extreme detail. First, classify it as "substantive" (e.g., a photograph, chart, diagram, table, document scan) or "decorative" (e.g., a simple icon, logo, border, ornamental graphic).
 
 If the image is **SUBSTANTIVE**, you must perform a comprehensive and exhaustive analysis. Your goal is to create a description so detailed that someone could reconstruct the image's key elements and meaning without seeing it. Cover the following aspects meticulously:
 
@@ -35,39 +46,166 @@ If the image is **DECORATIVE**, provide a brief, one-sentence description of wha
   "description": "Your detailed analysis goes here. For substantive images, this should be a multi-paragraph, exhaustive description. For decorative, a single sentence.",
   "rawText": "All extracted text, numbers, and symbols go here. If no text is present, provide an empty string."
 }"""
-    
-    payload = {
-        "contents": [{"parts": [{"text": prompt}, {"inline_data": {"mime_type": "image/png", "data": base64.b64encode(image_bytes).decode()}}]}],
-        "generationConfig": {"responseMimeType": "application/json"}
-    }
-    
-    retries = 3
-    while retries > 0:
-        try:
-            async with session.post(vision_api_url, json=payload, headers=headers) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    try:
-                        json_text = data.get("candidates", [{}])[0].get("content", {}).get("parts", [{}])[0].get("text", "{}")
-                        return json.loads(json_text)
-                    except (json.JSONDecodeError, IndexError):
-                        return {"description": "AI analysis failed to return valid JSON.", "contentType": "error", "rawText": ""}
-                        
-                elif response.status == 429:  # Rate limit
-                    retries -= 1
-                    if retries > 0:
-                        wait_time = (4 - retries) * 2
-                        await asyncio.sleep(wait_time)
-                        continue
-                    return {"description": "Rate limit exceeded", "contentType": "error", "rawText": ""}
-                else:
-                    return {"description": f"API error {response.status}", "contentType": "error", "rawText": ""}
-                    
-        except (aiohttp.ClientError, asyncio.TimeoutError):
-            retries -= 1
-            if retries > 0:
-                await asyncio.sleep(5)
+
+
+# Cache of successful analyses keyed by image content hash, so duplicate
+# images (logos, repeated figures) don't pay for a second Gemini call.
+analysis_cache: Dict[str, Dict[str, Any]] = {}
+
+_ERROR_RESULT = {"description": "AI analysis failed.", "contentType": "error", "rawText": ""}
+
+
+def _batch_prompt(n: int) -> str:
+    """Wraps the per-image prompt with instructions for an N-image batch."""
+    return (
+        f"You will receive {n} images. Apply the analysis below to EACH image "
+        f"independently, and return a single valid JSON array of exactly {n} "
+        "objects, one per image in the order the images appear. Do not include "
+        "any text outside the JSON array.\n\n" + VISION_PROMPT
+    )
+
+# Uploaded file URIs keyed by content hash: duplicate images and retries
+# reference the existing Files API object instead of re-sending the bytes.
+_file_uri_cache: Dict[str, str] = {}
+
+async def upload_image_to_gemini(session: aiohttp.ClientSession, image_bytes: bytes, vision_api_url: str, mime_type: str = "image/png") -> str | None:
+    """Uploads raw image bytes via the Files API and returns the file URI."""
+    content_hash = xxhash.xxh3_128_hexdigest(image_bytes)
+    cached_uri = _file_uri_cache.get(content_hash)
+    if cached_uri is not None:
+        return cached_uri
+    try:
+        # The generateContent URL already carries the API key; reuse it
+        api_key = parse_qs(urlsplit(vision_api_url).query).get("key", [""])[0]
+        upload_headers = {
+            "Content-Type": mime_type,
+            "X-Goog-Upload-Protocol": "raw",
+        }
+        async with session.post(
+            f"{GEMINI_UPLOAD_URL}?key={api_key}", data=image_bytes, headers=upload_headers
+        ) as response:
+            if response.status == 200:
+                info = await response.json()
+                file_uri = info.get("file", {}).get("uri")
+                if file_uri:
+                    _file_uri_cache[content_hash] = file_uri
+                return file_uri
+            print(f"Gemini media upload failed with status {response.status}")
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"Gemini media upload error: {e}")
+    return None
+
+async def get_ai_visual_analyses(session: aiohttp.ClientSession, images: List[Tuple[bytes, str]], vision_api_url: str, cache_keys: List[str] | None = None) -> List[Dict[str, Any]]:
+    """Analyzes a batch of images with one generateContent call.
+
+    ``images`` is a list of (image_bytes, mime_type) pairs; the result list
+    lines up with it by index. Batching all of a page's images into a single
+    request amortizes the TLS/HTTP round-trip and the model invocation over
+    the whole page instead of paying it per image.
+
+    ``cache_keys`` lets the caller key the analysis cache on something more
+    stable than the payload — main passes the hash of the *original* image
+    bytes, so the same source image hits the cache even if the resize/render
+    path produced different payload bytes. Falls back to hashing the payload.
+    """
+    results: List[Dict[str, Any] | None] = [None] * len(images)
+
+    if cache_keys is None:
+        cache_keys = [xxhash.xxh3_128_hexdigest(image_bytes) for image_bytes, _ in images]
+
+    # Serve duplicates from the cache and only ship the rest to Gemini
+    pending: List[int] = []
+    for i, cache_key in enumerate(cache_keys):
+        cached = analysis_cache.get(cache_key)
+        if cached is not None:
+            print("Vision analysis cache hit.")
+            results[i] = cached
+        else:
+            pending.append(i)
+
+    if not pending:
+        return results
+
+    headers = {"Content-Type": "application/json"}
+
+    async with VISION_SEMAPHORE:
+        # Upload the raw bytes once per image and reference them by URI,
+        # skipping the 4/3 base64 inflation of the generateContent payload
+        file_uris = await asyncio.gather(*(
+            upload_image_to_gemini(session, images[i][0], vision_api_url, images[i][1])
+            for i in pending
+        ))
+
+        parts: List[Dict[str, Any]] = [{"text": _batch_prompt(len(pending))}]
+        for i, file_uri in zip(pending, file_uris):
+            image_bytes, mime_type = images[i]
+            if file_uri:
+                parts.append({"file_data": {"mime_type": mime_type, "file_uri": file_uri}})
             else:
-                return {"description": "Network error", "contentType": "error", "rawText": ""}
-    
-    return {"description": "Failed after retries", "contentType": "error", "rawText": ""}
\ No newline at end of file
+                # Fall back to the inline path if the media upload is unavailable
+                parts.append({"inline_data": {"mime_type": mime_type, "data": base64.b64encode(image_bytes).decode()}})
+
+        payload = {
+            "contents": [{"parts": parts}],
+            "generationConfig": _GENERATION_CONFIG
+        }
+
+        batch = None
+        max_retries = 5
+        for attempt in range(max_retries):
+            # Capped exponential backoff with jitter so concurrent retries
+            # decorrelate instead of re-hammering the quota in lockstep
+            backoff = min(60, 2 ** (attempt + 1))
+            try:
+                async with session.post(vision_api_url, json=payload, headers=headers) as response:
+                    if response.status == 200:
+                        # Decode straight from the raw bytes with orjson's C
+                        # parser instead of stdlib json via response.json()
+                        data = orjson.loads(await response.read())
+                        try:
+                            json_text = data.get("candidates", [{}])[0].get("content", {}).get("parts", [{}])[0].get("text", "[]")
+                            batch = orjson.loads(json_text)
+                        except (orjson.JSONDecodeError, IndexError):
+                            batch = None
+                        break
+
+                    elif response.status == 429:  # Rate limit
+                        if attempt < max_retries - 1:
+                            # Honor the server's Retry-After hint when present
+                            wait_time = float(response.headers.get("Retry-After", backoff))
+                            await asyncio.sleep(wait_time + random.uniform(0, backoff / 2))
+                            continue
+                        batch = None
+                        break
+                    else:
+                        print(f"Vision API error {response.status}")
+                        batch = None
+                        break
+
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt < max_retries - 1:
+                    await asyncio.sleep(backoff + random.uniform(0, backoff / 2))
+                else:
+                    batch = None
+
+    # A single object response for a one-image batch is close enough; any
+    # other shape mismatch degrades to per-image error placeholders
+    if isinstance(batch, dict):
+        batch = [batch]
+    if not isinstance(batch, list):
+        batch = []
+
+    for slot, i in enumerate(pending):
+        if slot < len(batch) and isinstance(batch[slot], dict):
+            results[i] = batch[slot]
+            analysis_cache[cache_keys[i]] = batch[slot]
+        else:
+            results[i] = dict(_ERROR_RESULT)
+
+    return results
+
+
+async def get_ai_visual_analysis(session: aiohttp.ClientSession, image_bytes: bytes, vision_api_url: str, mime_type: str = "image/png") -> Dict[str, Any]:
+    """Gets a structured JSON analysis for a single image."""
+    analyses = await get_ai_visual_analyses(session, [(image_bytes, mime_type)], vision_api_url)
+    return analyses[0]
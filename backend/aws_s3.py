@@ -1,18 +1,79 @@
+import asyncio
 import boto3
+import functools
+import io
 import mimetypes
 import os
+import re
+import secrets
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
+# Characters that are unsafe (or need escaping) in S3 object keys
+_UNSAFE_KEY_CHARS = re.compile(r'[^A-Za-z0-9._-]+')
+
 class AWSS3:
-    def __init__(self, bucket_name: str):
+    def __init__(self, bucket_name: str, max_concurrency: int = 16):
         self.bucket_name = bucket_name
+        self.max_concurrency = max_concurrency
         self.s3_client = boto3.client(
             's3',
             aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
             aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
-            region_name=os.getenv('AWS_REGION', 'us-east-1')
+            region_name=os.getenv('AWS_REGION', 'us-east-1'),
+            config=Config(max_pool_connections=max_concurrency, tcp_keepalive=True)
         )
     
+    async def put_many(self, session, items) -> list:
+        """Upload many (filename, file_bytes) pairs in parallel.
+
+        Concurrency is bounded to match the client's connection pool so
+        parallel puts saturate bandwidth without exhausting sockets.
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        
+        async def upload_one(filename, file_bytes):
+            async with semaphore:
+                return await self.put(session, filename, file_bytes)
+        
+        return await asyncio.gather(*(upload_one(f, b) for f, b in items))
+    
+    async def put_file(self, session, filename: str, file_path: str) -> str:
+        """Upload a file from disk without buffering it in memory.
+
+        upload_fileobj reads the handle in chunks (multipart for large
+        bodies), so the document never has to exist as one bytes object.
+        """
+        try:
+            content_type, _ = mimetypes.guess_type(filename)
+            if not content_type:
+                content_type = 'application/octet-stream'
+
+            safe_name = _UNSAFE_KEY_CHARS.sub('_', filename)
+            unique_key = f"{secrets.token_urlsafe(9)}-{safe_name}"
+
+            def upload():
+                with open(file_path, 'rb') as fh:
+                    self.s3_client.upload_fileobj(
+                        fh,
+                        self.bucket_name,
+                        unique_key,
+                        ExtraArgs={
+                            'ContentType': content_type,
+                            'ContentDisposition': f'inline; filename="{filename}"'
+                        }
+                    )
+            await asyncio.get_running_loop().run_in_executor(None, upload)
+
+            return f"https://{self.bucket_name}.s3.amazonaws.com/{unique_key}"
+
+        except ClientError as e:
+            print(f"S3 upload error: {e}")
+            raise Exception(f"S3 upload failed: {str(e)}")
+        except Exception as e:
+            print(f"Upload exception: {e}")
+            raise
+
     async def put(self, session, filename: str, file_bytes: bytes) -> str:
         """Upload file to S3 with inline Content-Disposition"""
         try:
@@ -20,18 +81,24 @@ class AWSS3:
             if not content_type:
                 content_type = 'application/octet-stream'
             
-            # Generate unique key
-            import uuid
-            unique_key = f"{uuid.uuid4().hex[:8]}-{filename}"
+            # Generate unique key: 72 random bits, so collisions stay
+            # negligible even across large corpora (8 hex chars were ~32 bits)
+            safe_name = _UNSAFE_KEY_CHARS.sub('_', filename)
+            unique_key = f"{secrets.token_urlsafe(9)}-{safe_name}"
             
-            # Upload with inline Content-Disposition
-            self.s3_client.put_object(
-                Bucket=self.bucket_name,
-                Key=unique_key,
-                Body=file_bytes,
-                ContentType=content_type,
-                ContentDisposition=f'inline; filename="{filename}"'
+            # Stream the upload in a worker thread so the event loop stays
+            # free; upload_fileobj also gives us multipart for large bodies
+            upload = functools.partial(
+                self.s3_client.upload_fileobj,
+                io.BytesIO(file_bytes),
+                self.bucket_name,
+                unique_key,
+                ExtraArgs={
+                    'ContentType': content_type,
+                    'ContentDisposition': f'inline; filename="{filename}"'
+                }
             )
+            await asyncio.get_running_loop().run_in_executor(None, upload)
             
             # Return public URL
             url = f"https://{self.bucket_name}.s3.amazonaws.com/{unique_key}"
@@ -1,6 +1,10 @@
+import re
 from pydantic import BaseModel
 from typing import List, Tuple, Union
-from bs4 import BeautifulSoup
+
+# The OCR block HTML is generated by our own code (a bare <p> wrapper),
+# so a compiled tag-stripper is all that's needed to get the text back.
+_TAG_RE = re.compile(r"<[^>]+>")
 
 class Cell(BaseModel):
     text: str
@@ -79,8 +83,7 @@ def generate_combined_markdown(content_blocks: List[Union[TextBlock, ImageBlock,
             text_content = "".join(span.text for span in block.spans)
             markdown_parts.append(text_content)
         elif block.type == "ocr_text_block":
-            soup = BeautifulSoup(block.html_content, 'html.parser')
-            markdown_parts.append(soup.get_text())
+            markdown_parts.append(_TAG_RE.sub("", block.html_content))
         elif block.type == "image":
             caption = block.caption or "Untitled Image"
             markdown_parts.append(f"{caption}\n\nVisual Description: {block.description}")
@@ -137,7 +140,11 @@ def create_header_footer_block(image_bbox, content: str) -> HeaderFooterTextBloc
 
 def sort_content_blocks(content_blocks: List) -> List:
     """Sort all blocks by reading order (top-to-bottom, left-to-right)"""
-    return sorted(content_blocks, key=lambda b: (b.bounding_box[1], b.bounding_box[0]))
+    # Decorate-sort-undecorate: read each block's bbox once up front so the
+    # comparator doesn't repeat attribute/index lookups per comparison
+    decorated = [((b.bounding_box[1], b.bounding_box[0]), b) for b in content_blocks]
+    decorated.sort(key=lambda t: t[0])
+    return [b for _, b in decorated]
 
 def build_page_data(page_num: int, page, content_blocks: List) -> dict:
     """Build final PageData structure as dict"""
@@ -147,6 +154,6 @@ def build_page_data(page_num: int, page, content_blocks: List) -> dict:
     return {
         "page_number": page_num + 1,
         "page_dimensions": {"width": page.rect.width, "height": page.rect.height},
-        "content_blocks": [block.dict() for block in sorted_blocks],
+        "content_blocks": [block.model_dump(mode="json") for block in sorted_blocks],
         "combined_markdown": combined_markdown
     }
\ No newline at end of file
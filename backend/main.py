@@ -1,8 +1,11 @@
 import os
 import fitz  # PyMuPDF
+import pdfplumber
+import xxhash
 import aiohttp
 import asyncio
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from fastapi import FastAPI, UploadFile, File, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from typing import List
@@ -10,8 +13,8 @@ from dotenv import load_dotenv
 
 # Import services
 from image_classifier import classify_image, resize_image_for_ai
-from ai_vision_service import get_ai_visual_analysis
-from pdf_processor import get_closest_caption, extract_text_blocks, identify_potential_captions, extract_images_from_page, extract_tables_from_page
+from ai_vision_service import get_ai_visual_analyses
+from pdf_processor import get_closest_caption, extract_text_blocks, extract_images_from_page, extract_tables_from_plumber_page, render_image_for_vision
 from content_builder import (
      create_text_block, create_image_block, create_table_block,
     create_ocr_text_block, create_header_footer_block, build_page_data
@@ -23,6 +26,9 @@ load_dotenv()
 
 # Configuration
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY") 
+# Images per batched generateContent call: big enough to amortize the HTTP
+# round-trip, small enough that one response reliably covers every image
+VISION_BATCH_SIZE = int(os.getenv("VISION_BATCH_SIZE", "6"))
 VISION_API_URL = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-pro-latest:generateContent?key={GOOGLE_API_KEY}"
 # UPLOADS_DIR = Path("uploads")
 
@@ -37,24 +43,64 @@ VISION_API_URL = f"https://generativelanguage.googleapis.com/v1beta/models/gemin
 # Initialize AWS S3 client
 s3_client = AWSS3(os.getenv('AWS_S3_BUCKET', 'your-bucket-name'))
 
+# Image classification (Tesseract + PIL + NumPy) is CPU-heavy, so it runs off
+# the event loop. Threads rather than processes: the dedup hash sets are
+# shared state mutated across calls, and the expensive steps (the Tesseract
+# subprocess, PIL decode, NumPy kernels) all release the GIL.
+classify_executor = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+# Cap in-flight S3 puts separately from the Gemini semaphore: S3 tolerates
+# far more parallelism than the vision API, but an unbounded burst of puts
+# still trips request throttling and exhausts the connection pool.
+S3_SEMAPHORE = asyncio.Semaphore(int(os.getenv("S3_CONCURRENCY", "64")))
+
 async def upload_to_s3(session: aiohttp.ClientSession, file_bytes: bytes, filename: str, wait_for_response: bool = True) -> str | None:
+    async def bounded_put():
+        async with S3_SEMAPHORE:
+            return await s3_client.put(session, filename, file_bytes)
+
     try:
         if wait_for_response:
-            url = await s3_client.put(session, filename, file_bytes)
+            url = await bounded_put()
             print(f"Got URL for {filename}: {url}")
             return url
         else:
             # Fire and forget
-            asyncio.create_task(s3_client.put(session, filename, file_bytes))
+            asyncio.create_task(bounded_put())
             print(f"File {filename} upload started")
             return None
     except Exception as e:
         print(f"Upload exception for {filename}: {e}")
         return "http://example.com/placeholder.png" if wait_for_response else None
 
+async def upload_pdf_to_s3(session: aiohttp.ClientSession, file_path: str, filename: str) -> str | None:
+    """Upload the source PDF straight from its temp file on disk."""
+    try:
+        async with S3_SEMAPHORE:
+            url = await s3_client.put_file(session, filename, file_path)
+        print(f"Got URL for {filename}: {url}")
+        return url
+    except Exception as e:
+        print(f"Upload exception for {filename}: {e}")
+        return "http://example.com/placeholder.png"
+
 # FastAPI App
 app = FastAPI()
 
+@app.on_event("startup")
+async def create_http_session():
+    # One app-lifetime session: S3 and Gemini connections survive across
+    # requests, so later calls skip the DNS + TCP + TLS handshake entirely.
+    app.state.http = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=100, limit_per_host=32, ttl_dns_cache=300, keepalive_timeout=75
+        )
+    )
+
+@app.on_event("shutdown")
+async def close_http_session():
+    await app.state.http.close()
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:3000"],
@@ -72,47 +118,103 @@ async def process_pdf(file: UploadFile = File(...)):
     if not GOOGLE_API_KEY:
         raise HTTPException(status_code=500, detail="AI API key is not configured.")
         
-    seen_hashes = set()
-    junk_hashes = set()
+    # Lists of imagehash.ImageHash values; dedup is a Hamming-distance scan
+    seen_hashes = []
+    junk_hashes = []
     final_data: List[dict] = []
-    file_bytes = await file.read()
-    pdf_document = fitz.open(stream=file_bytes, filetype="pdf")
 
+    # Stream the upload to disk in 1 MiB chunks: the document never has to
+    # exist as one in-memory bytes object, so peak RSS stays ~flat however
+    # large the PDF is. Both parsers and the S3 upload read from this file.
     with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as temp_pdf:
-        temp_pdf.write(file_bytes)
         temp_pdf_path = temp_pdf.name
-    
-    async with aiohttp.ClientSession() as session:
-        # Start PDF upload in the background
-        pdf_upload_task = asyncio.create_task(upload_to_s3(session, file_bytes, file.filename or "document.pdf"))
+        while chunk := await file.read(1 << 20):
+            temp_pdf.write(chunk)
+
+    # Start the PDF upload before any parsing begins: the uploader streams
+    # from the temp file in its own worker thread, so the whole document
+    # transfer overlaps the fitz/pdfplumber CPU work below.
+    session = app.state.http
+    pdf_upload_task = asyncio.create_task(upload_pdf_to_s3(session, temp_pdf_path, file.filename or "document.pdf"))
+    await asyncio.sleep(0)  # let the upload task reach its first I/O
 
-        # --- Phase 1: Collect all images and metadata from all pages ---
-        all_image_metadata = []
-        page_content_blocks = [[] for _ in range(len(pdf_document))]
+    pdf_document = fitz.open(temp_pdf_path)
 
-        for page_num in range(len(pdf_document)):
-            page = pdf_document.load_page(page_num)
-            page_dict = page.get_text("dict")
+    # Load each page object once; later phases index these instead of
+    # re-parsing the page dictionary with repeated load_page calls
+    pages = [pdf_document.load_page(i) for i in range(len(pdf_document))]
+    page_sizes = [(p.rect.width, p.rect.height) for p in pages]
+
+    # --- Phase 1: Collect all images and metadata from all pages ---
+    # Pages are independent, so run them as parallel coroutines: the
+    # classification executor keeps several pages' images in flight at
+    # once while the loop stays free. The semaphore bounds how many
+    # pages queue work simultaneously.
+    page_semaphore = asyncio.Semaphore(int(os.getenv("PAGE_CONCURRENCY", "10")))
+
+    # Blocking parse calls run via to_thread so they don't stall the event
+    # loop (or other requests). Neither MuPDF documents nor pdfplumber pages
+    # are thread-safe, so a lock per library serializes access while still
+    # letting parsing overlap network I/O and classification.
+    fitz_lock = asyncio.Lock()
+    plumber_lock = asyncio.Lock()
+
+    # One S3 upload per distinct image content: repeated figures share the
+    # first task's URL instead of re-sending the same bytes
+    upload_tasks_by_hash: dict[str, asyncio.Task] = {}
+
+    def upload_image_once(content_hash: str, image_bytes: bytes, filename: str) -> asyncio.Task:
+        task = upload_tasks_by_hash.get(content_hash)
+        if task is None:
+            task = asyncio.create_task(upload_to_s3(session, image_bytes, filename))
+            upload_tasks_by_hash[content_hash] = task
+        return task
+
+    async def collect_page_content(page_num: int) -> tuple:
+        """Phase-1 work for one page: tables, text blocks and image triage.
+
+        I/O for the page is scheduled before returning — OCR-bound images
+        start their S3 upload and the page's vision batch starts its Gemini
+        call while other pages are still classifying, so the network work
+        pipelines behind classification instead of waiting for Phase 1 to
+        finish everywhere.
+        """
+        blocks = []
+        image_metadata = []
+        async with page_semaphore:
+            page = pages[page_num]
+            async with fitz_lock:
+                # Text walk only needs blocks/lines/spans; skipping image
+                # block collection avoids copying every image's pixels into
+                # the dict (image areas come from extract_images_from_page)
+                page_dict = await asyncio.to_thread(
+                    page.get_text, "dict",
+                    flags=fitz.TEXTFLAGS_DICT & ~fitz.TEXT_PRESERVE_IMAGES
+                )
 
             # --- MODIFICATION: Extract tables and their areas ---
-            tables_with_coords_and_font = extract_tables_from_page(temp_pdf_path, page_num + 1)
+            async with plumber_lock:
+                tables_with_coords_and_font = await asyncio.to_thread(
+                    extract_tables_from_plumber_page, plumber_pdf.pages[page_num]
+                )
             table_areas = [bbox for _, bbox, _ in tables_with_coords_and_font]
-            
+
             for table_data, bbox, avg_font_size in tables_with_coords_and_font:
-                page_content_blocks[page_num].append(create_table_block(table_data, bbox, avg_font_size))
+                blocks.append(create_table_block(table_data, bbox, avg_font_size))
 
-            potential_captions = identify_potential_captions(page_dict)
-            image_data = extract_images_from_page(page, pdf_document)
+            async with fitz_lock:
+                image_data = await asyncio.to_thread(extract_images_from_page, page, pdf_document)
             image_areas = [img['bbox'] for img in image_data]
 
-            text_blocks = extract_text_blocks(page_dict, table_areas, image_areas)
-            page_content_blocks[page_num].extend([create_text_block(block_data) for block_data in text_blocks])
-            
+            text_blocks, potential_captions = extract_text_blocks(page_dict, table_areas, image_areas)
+            blocks.extend(create_text_block(block_data) for block_data in text_blocks)
+
+            page_width, page_height = page_sizes[page_num]
             for img_info in image_data:
                 visual_id = f"page_{page_num + 1}_img_{img_info['index']}"
-                page_width, page_height = page.rect.width, page.rect.height
-                
-                classification, harvested_text = classify_image(
+
+                classification, harvested_text = await asyncio.get_running_loop().run_in_executor(
+                    classify_executor, classify_image,
                     img_info['image_bytes'], img_info['width'], img_info['height'],
                     page_width, page_height, seen_hashes, junk_hashes
                 )
@@ -121,11 +223,11 @@ async def process_pdf(file: UploadFile = File(...)):
                     continue
                 if classification == 'background':
                     if harvested_text:
-                        page_content_blocks[page_num].append(create_header_footer_block(img_info['bbox'], harvested_text))
+                        blocks.append(create_header_footer_block(img_info['bbox'], harvested_text))
                     continue
 
                 # This image needs to be uploaded (either for OCR or Vision)
-                all_image_metadata.append({
+                image_metadata.append({
                     'page_num': page_num,
                     'visual_id': visual_id,
                     'classification': classification,
@@ -134,73 +236,127 @@ async def process_pdf(file: UploadFile = File(...)):
                     'caption': get_closest_caption(img_info['bbox'], potential_captions),
                 })
 
-        # --- Phase 2: Upload all collected images in parallel ---
-        upload_tasks = [
-            upload_to_s3(session, meta['img_info']['image_bytes'], f"{meta['visual_id']}.png")
-            for meta in all_image_metadata
-        ]
-        print(f"Starting parallel upload of {len(upload_tasks)} images...")
-        image_urls = await asyncio.gather(*upload_tasks)
-
-        # Add URLs to metadata
-        for i, url in enumerate(image_urls):
-            all_image_metadata[i]['image_url'] = url
-
-        # --- Phase 3: Create Vision AI tasks for substantive images ---
-        vision_tasks = []
-        vision_metadata = []
-        for meta in all_image_metadata:
-            if meta['classification'] == 'ocr':
-                page_content_blocks[meta['page_num']].append(
-                    create_ocr_text_block(meta['img_info']['bbox'], meta['harvested_text'], meta['image_url'])
-                )
-            else: # Assumes default is substantive/vision
+            # Kick off this page's network work immediately. Vision-classified
+            # images are NOT uploaded here: the model may still declare them
+            # decorative, and discarded images shouldn't cost an S3 round-trip
+            # (they upload in Phase 5 once confirmed keepers).
+            vision_metas, vision_images, vision_keys = [], [], []
+            for meta in image_metadata:
                 img_info = meta['img_info']
-                page = pdf_document.load_page(meta['page_num'])
-                page_width, page_height = page.rect.width, page.rect.height
-                
-                resized_image_bytes = resize_image_for_ai(
-                    img_info['image_bytes'], img_info['width'], img_info['height'], page_width, page_height
-                )
-                vision_tasks.append(get_ai_visual_analysis(session, resized_image_bytes, VISION_API_URL))
-                vision_metadata.append(meta)
-
-        # --- Phase 4: Execute all Vision AI tasks in parallel ---
-        print(f"Starting parallel processing of {len(vision_tasks)} vision tasks...")
-        ai_results = await asyncio.gather(*vision_tasks)
-
-        # --- Phase 5: Process AI results ---
-        for i, ai_analysis in enumerate(ai_results):
-            meta = vision_metadata[i]
-            
-            # Prepare metadata for block creation
-            block_metadata = {
-                'image_bbox': meta['img_info']['bbox'],
-                'visual_id': meta['visual_id'],
-                'caption': meta['caption'],
-                'width': meta['img_info']['width'],
-                'height': meta['img_info']['height']
-            }
-
-            if ai_analysis.get("contentType") == 'decorative':
-                if ai_analysis.get("rawText"):
-                    page_content_blocks[meta['page_num']].append(
-                        create_header_footer_block(block_metadata['image_bbox'], ai_analysis.get("rawText"))
+                meta['content_hash'] = xxhash.xxh3_128_hexdigest(img_info['image_bytes'])
+                if meta['classification'] == 'ocr':
+                    meta['upload_task'] = upload_image_once(
+                        meta['content_hash'], img_info['image_bytes'], f"{meta['visual_id']}.png"
                     )
-            else:
+                else: # Assumes default is substantive/vision
+                    # Prefer the native pixmap render; PIL remains the
+                    # fallback for encodings the pixmap path can't normalize.
+                    # Both are CPU-bound decode/encode work, so they run in
+                    # worker threads (fitz access still serialized) instead
+                    # of on the event loop.
+                    async with fitz_lock:
+                        rendered = await asyncio.to_thread(
+                            render_image_for_vision,
+                            pdf_document, img_info['xref'], img_info['width'], img_info['height'], page_width, page_height
+                        )
+                    if rendered is None:
+                        rendered = await asyncio.get_running_loop().run_in_executor(
+                            classify_executor, resize_image_for_ai,
+                            img_info['image_bytes'], img_info['width'], img_info['height'], page_width, page_height
+                        )
+                    vision_metas.append(meta)
+                    vision_images.append(rendered)
+                    # Key the analysis cache on the original bytes so
+                    # reprocessing the same source image hits even if the
+                    # render path changes
+                    vision_keys.append(meta['content_hash'])
+
+            # Split oversized pages into batches of VISION_BATCH_SIZE so a
+            # single response never has to describe a dozen images (long
+            # outputs get truncated) and the batches run concurrently
+            vision_chunks = []
+            for start in range(0, len(vision_metas), VISION_BATCH_SIZE):
+                end = start + VISION_BATCH_SIZE
+                task = asyncio.create_task(get_ai_visual_analyses(
+                    session, vision_images[start:end], VISION_API_URL, vision_keys[start:end]
+                ))
+                vision_chunks.append((vision_metas[start:end], task))
+
+        return blocks, image_metadata, vision_chunks
+
+    # One pdfplumber parse for the whole document
+    with pdfplumber.open(temp_pdf_path) as plumber_pdf:
+        page_results = await asyncio.gather(
+            *(collect_page_content(i) for i in range(len(pdf_document)))
+        )
+    page_content_blocks = [blocks for blocks, _, _ in page_results]
+    all_image_metadata = [meta for _, metas, _ in page_results for meta in metas]
+
+    # --- Phase 2: Collect OCR upload results (already in flight) ---
+    ocr_metadata = [meta for meta in all_image_metadata if meta['classification'] == 'ocr']
+    image_urls = await asyncio.gather(*(meta.pop('upload_task') for meta in ocr_metadata))
+    for meta, url in zip(ocr_metadata, image_urls):
+        meta['image_url'] = url
+        page_content_blocks[meta['page_num']].append(
+            create_ocr_text_block(meta['img_info']['bbox'], meta['harvested_text'], url)
+        )
+
+    # --- Phase 4: Collect the vision batches (already in flight) ---
+    vision_page_results = [chunk for _, _, chunks in page_results for chunk in chunks]
+    print(f"Collecting {len(vision_page_results)} vision batches...")
+    batch_results = await asyncio.gather(*(task for _, task in vision_page_results))
+
+    # Flatten the per-page batches back into index-aligned lists
+    vision_metadata = [meta for metas, _ in vision_page_results for meta in metas]
+    ai_results = [analysis for analyses in batch_results for analysis in analyses]
+
+    # --- Phase 5: Process AI results ---
+    # Upload only the images the model kept; decorative hits never touch S3
+    kept_indices = [
+        i for i, ai_analysis in enumerate(ai_results)
+        if ai_analysis.get("contentType") != 'decorative'
+    ]
+    kept_urls = await asyncio.gather(*(
+        upload_image_once(
+            vision_metadata[i]['content_hash'],
+            vision_metadata[i]['img_info']['image_bytes'],
+            f"{vision_metadata[i]['visual_id']}.png"
+        )
+        for i in kept_indices
+    ))
+    for i, url in zip(kept_indices, kept_urls):
+        vision_metadata[i]['image_url'] = url
+
+    for i, ai_analysis in enumerate(ai_results):
+        meta = vision_metadata[i]
+        
+        # Prepare metadata for block creation
+        block_metadata = {
+            'image_bbox': meta['img_info']['bbox'],
+            'visual_id': meta['visual_id'],
+            'caption': meta['caption'],
+            'width': meta['img_info']['width'],
+            'height': meta['img_info']['height']
+        }
+
+        if ai_analysis.get("contentType") == 'decorative':
+            if ai_analysis.get("rawText"):
                 page_content_blocks[meta['page_num']].append(
-                    create_image_block(block_metadata, ai_analysis, meta['image_url'])
+                    create_header_footer_block(block_metadata['image_bbox'], ai_analysis.get("rawText"))
                 )
+        else:
+            page_content_blocks[meta['page_num']].append(
+                create_image_block(block_metadata, ai_analysis, meta['image_url'])
+            )
 
-        # --- Phase 6: Build final response ---
-        for page_num in range(len(pdf_document)):
-            page = pdf_document.load_page(page_num)
-            final_page_data = build_page_data(page_num, page, page_content_blocks[page_num])
-            final_data.append(final_page_data)
-            
-        pdf_url = await pdf_upload_task
+    # --- Phase 6: Build final response ---
+    for page_num in range(len(pdf_document)):
+        final_page_data = build_page_data(page_num, pages[page_num], page_content_blocks[page_num])
+        final_data.append(final_page_data)
+        
+    pdf_url = await pdf_upload_task
 
     # Clean up the temporary file
     os.unlink(temp_pdf_path)
-        
+
     return {"data": final_data, "pdf_url": pdf_url}
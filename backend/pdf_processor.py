@@ -1,77 +1,148 @@
 import fitz
+import math
 import re
+from bisect import bisect_right
+from itertools import chain
+from operator import itemgetter
+import numpy as np
 import pdfplumber
+from functools import lru_cache
 from typing import List, Dict, Tuple, Any
 
-def extract_tables_from_page(pdf_path: str, page_num: int) -> List[Tuple[List[List[str | None]], Tuple[float, float, float, float], float]]:
-    """Extract tables from a specific page of a PDF using pdfplumber, including average font size."""
+# Span flag bits from MuPDF (TEXT_FONT_BOLD / TEXT_FONT_ITALIC)
+FLAG_BOLD = 16
+FLAG_ITALIC = 2
+
+# Compiled once at import; identify_potential_captions runs per page
+CAPTION_PATTERN = re.compile(r'^\s*(fig|figure|table|chart)\.?\s*[\w\.]+|^\s*\(\w\)', re.IGNORECASE)
+
+# C-level field extraction for the hot span-join path
+_GET_TEXT = itemgetter('text')
+
+@lru_cache(maxsize=256)
+def _format_color(color: int) -> str:
+    """Hex-format a span color; documents reuse a handful of colors, so
+    memoizing turns thousands of %-format calls into dict hits."""
+    return '#%06x' % color
+
+def extract_tables_from_plumber_page(page) -> List[Tuple[List[List[str | None]], Tuple[float, float, float, float], float]]:
+    """Extract tables from an already-open pdfplumber page, including average font size.
+
+    The caller opens the document once and hands pages in; re-opening the
+    PDF per page re-parsed the xref table and rebuilt every page object.
+    """
     tables_with_coords_and_font = []
     try:
-        with pdfplumber.open(pdf_path) as pdf:
-            page = pdf.pages[page_num - 1]
-            found_tables = page.find_tables()
-            
-            all_chars = page.chars
-
-            for table in found_tables:
-                table_data = table.extract()
-                bbox = table.bbox  # (x0, top, x1, bottom)
-                
-                # Find average font size of text within the table bbox
-                x0, y0, x1, y1 = bbox
-                table_chars = [
-                    char for char in all_chars
-                    if char['x0'] >= x0 and char['x1'] <= x1 and
-                       char['top'] >= y0 and char['bottom'] <= y1
-                ]
-                
-                if table_chars:
-                    avg_font_size = sum(c['size'] for c in table_chars) / len(table_chars)
-                else:
-                    avg_font_size = 8.0 # A default fallback
+        found_tables = page.find_tables()
+        if not found_tables:
+            return tables_with_coords_and_font
 
-                tables_with_coords_and_font.append((table_data, bbox, avg_font_size))
+        # Pull the char coordinates into flat arrays once per page; each
+        # table's containment test is then four vectorized compares instead
+        # of a Python loop over every char
+        all_chars = page.chars
+        n = len(all_chars)
+        cx0 = np.fromiter((c['x0'] for c in all_chars), dtype=np.float32, count=n)
+        cx1 = np.fromiter((c['x1'] for c in all_chars), dtype=np.float32, count=n)
+        ctop = np.fromiter((c['top'] for c in all_chars), dtype=np.float32, count=n)
+        cbottom = np.fromiter((c['bottom'] for c in all_chars), dtype=np.float32, count=n)
+        csize = np.fromiter((c['size'] for c in all_chars), dtype=np.float32, count=n)
+
+        for table in found_tables:
+            table_data = table.extract()
+            bbox = table.bbox  # (x0, top, x1, bottom)
+
+            # Find average font size of text within the table bbox
+            x0, y0, x1, y1 = bbox
+            mask = (cx0 >= x0) & (cx1 <= x1) & (ctop >= y0) & (cbottom <= y1)
+
+            if mask.any():
+                avg_font_size = float(csize[mask].mean())
+            else:
+                avg_font_size = 8.0 # A default fallback
+
+            tables_with_coords_and_font.append((table_data, bbox, avg_font_size))
     except Exception as e:
-        print(f"Could not extract tables from page {page_num} using pdfplumber: {e}")
+        print(f"Could not extract tables from page {page.page_number} using pdfplumber: {e}")
     return tables_with_coords_and_font
 
-def get_closest_caption(image_bbox: fitz.Rect, potential_captions: List[Dict]) -> str | None:
+def get_closest_caption(image_bbox: fitz.Rect, potential_captions: List[Tuple[float, str]]) -> str | None:
     """
-    Finds the closest text block that matches a caption pattern for a given image.
+    Finds the closest caption candidate for a given image.
     Prioritizes captions located directly below the image.
+
+    ``potential_captions`` is the y0-sorted list of (y0, text) pairs that
+    extract_text_blocks returns, so one bisect lands on the nearest
+    candidate below the image instead of scanning every caption per image.
     """
-    closest_caption_text = None
-    min_distance = float('inf')
+    idx = bisect_right(potential_captions, image_bbox.y1, key=itemgetter(0))
+    if idx < len(potential_captions):
+        y0, caption_text = potential_captions[idx]
+        if y0 - image_bbox.y1 < 50: # 50 points threshold
+            return caption_text
+    return None
 
-    for block in potential_captions:
-        caption_bbox = fitz.Rect(block['bbox'])
-        
-        if caption_bbox.y0 > image_bbox.y1:
-            
-            # Calculate vertical distance from image bottom to caption top
-            distance = caption_bbox.y0 - image_bbox.y1
-            
-            # Find the closest one that is reasonably near
-            if 0 <= distance < min_distance and distance < 50: # 50 points threshold
-                min_distance = distance
-                caption_text = " ".join(
-                    span['text'] 
-                    for line in block.get('lines', []) 
-                    for span in line.get('spans', [])
-                ).strip()
-                closest_caption_text = caption_text
-                
-    return closest_caption_text
+# Coverage-grid resolution: ~2-3pt cells on a letter page, 60 KB of uint8,
+# comfortably L1/L2-resident
+_GRID_W, _GRID_H = 200, 300
+
+def _cell_range(a0: float, a1: float, scale: float, limit: int) -> Tuple[int, int]:
+    """Map a [a0, a1) extent in page points to a non-empty cell slice."""
+    c0 = max(0, min(limit - 1, int(a0 * scale)))
+    c1 = max(c0 + 1, min(limit, math.ceil(a1 * scale)))
+    return c0, c1
 
-def extract_text_blocks(page_dict: Dict, table_areas: List[Tuple[float, float, float, float]], image_areas: List[Tuple[float, float, float, float]]) -> List[Dict]:
-    """Extract text blocks, excluding any that fall within table or image areas."""
+def extract_text_blocks(page_dict: Dict, table_areas: List[Tuple[float, float, float, float]], image_areas: List[Tuple[float, float, float, float]]) -> Tuple[List[Dict], List[Tuple[Tuple[float, float, float, float], str]]]:
+    """Extract text blocks, excluding any that fall within table or image areas.
+
+    Caption candidates are collected in the same walk: the block dict is
+    often the largest structure on the page, and a separate caption pass
+    would traverse it (and re-join every block's spans) a second time.
+    Returns (content_blocks, potential_captions) where each caption is a
+    (y0, joined_text) pair, sorted by y0 for bisect lookups.
+    """
     content_blocks = []
+    potential_captions = []
+
+    # Rasterize the exclusion areas into a small uint8 grid once per page:
+    # bit 1 marks table coverage, bit 2 image coverage. Each text block then
+    # resolves with one sliced any() (table overlap) and four corner reads
+    # (image containment) instead of per-rectangle geometry — O(1) per block
+    # regardless of how many areas the page carries.
+    page_w = float(page_dict.get('width') or 612.0)
+    page_h = float(page_dict.get('height') or 792.0)
+    sx, sy = _GRID_W / page_w, _GRID_H / page_h
+    grid = np.zeros((_GRID_H, _GRID_W), dtype=np.uint8)
+    for x0, y0, x1, y1 in (tuple(a) for a in table_areas):
+        cx0, cx1 = _cell_range(x0, x1, sx, _GRID_W)
+        cy0, cy1 = _cell_range(y0, y1, sy, _GRID_H)
+        grid[cy0:cy1, cx0:cx1] |= 1
+    for x0, y0, x1, y1 in (tuple(a) for a in image_areas):
+        cx0, cx1 = _cell_range(x0, x1, sx, _GRID_W)
+        cy0, cy1 = _cell_range(y0, y1, sy, _GRID_H)
+        grid[cy0:cy1, cx0:cx1] |= 2
 
     for block in page_dict.get("blocks", []):
         if block['type'] == 0:  # Text block
-            block_bbox = fitz.Rect(block['bbox'])
-            in_table = any(block_bbox.intersects(fitz.Rect(area)) for area in table_areas)
-            in_image = any(fitz.Rect(area).contains(block_bbox) for area in image_areas)
+            # chain + map push the span iteration and field lookup into C;
+            # only the per-line spans access stays in Python for the
+            # .get default
+            block_text = " ".join(map(_GET_TEXT, chain.from_iterable(
+                line.get('spans', ()) for line in block.get('lines', ())
+            ))).strip()
+            if CAPTION_PATTERN.match(block_text):
+                potential_captions.append((block['bbox'][1], block_text))
+
+            bx0, by0, bx1, by1 = block['bbox']
+            cx0, cx1 = _cell_range(bx0, bx1, sx, _GRID_W)
+            cy0, cy1 = _cell_range(by0, by1, sy, _GRID_H)
+            # Any table-covered cell under the block means overlap
+            in_table = bool((grid[cy0:cy1, cx0:cx1] & 1).any())
+            # All four corners inside image coverage means containment
+            in_image = bool(
+                grid[cy0, cx0] & grid[cy0, cx1 - 1]
+                & grid[cy1 - 1, cx0] & grid[cy1 - 1, cx1 - 1] & 2
+            )
 
             if not in_table and not in_image:
                 spans_data = []
@@ -82,9 +153,9 @@ def extract_text_blocks(page_dict: Dict, table_areas: List[Tuple[float, float, f
                             'text': span['text'],
                             'font': span['font'],
                             'size': span['size'],
-                            'color': '#%06x' % span['color'],
-                            'is_bold': bool(flags & 2**4),
-                            'is_italic': bool(flags & 2**1),
+                            'color': _format_color(span['color']),
+                            'is_bold': bool(flags & FLAG_BOLD),
+                            'is_italic': bool(flags & FLAG_ITALIC),
                             'is_line_end': span_idx == len(line.get("spans", [])) - 1
                         })
                 
@@ -94,25 +165,42 @@ def extract_text_blocks(page_dict: Dict, table_areas: List[Tuple[float, float, f
                     'spans': spans_data
                 })
     
-    return content_blocks
+    potential_captions.sort(key=itemgetter(0))
+    return content_blocks, potential_captions
 
-def identify_potential_captions(page_dict: Dict) -> List[Dict]:
-    """Identify potential caption blocks using regex patterns"""
-    caption_pattern = re.compile(r'^\s*(fig|figure|table|chart)\.?\s*[\w\.]+|^\s*\(\w\)', re.IGNORECASE)
-    potential_captions = []
-    all_text_blocks = [b for b in page_dict.get("blocks", []) if b.get('type') == 0]
-    
-    for block in all_text_blocks:
-        block_text = " ".join(
-            span['text'] 
-            for line in block.get('lines', []) 
-            for span in line.get('spans', [])
-        ).strip()
-        
-        if caption_pattern.match(block_text):
-            potential_captions.append(block)
-    
-    return potential_captions
+def render_image_for_vision(pdf_document: fitz.Document, xref: int, img_width: int, img_height: int, page_width: float, page_height: float) -> Tuple[bytes, str] | None:
+    """Render a downscaled copy of an embedded image straight from its xref.
+
+    fitz decodes the stream into a pixmap and shrink() halves it entirely in
+    C, so the PIL decode -> thumbnail -> re-encode round-trip is skipped for
+    the common case. The size budget matches resize_image_for_ai: 400-800px
+    scaled by the image's share of the page. Returns None when the pixmap
+    path can't handle the encoding, so the caller can fall back to PIL.
+    """
+    min_target_size = 400
+    max_target_size = 800
+    image_area = img_width * img_height
+    page_area = page_width * page_height
+    coverage_ratio = image_area / page_area if page_area > 0 else 0
+    max_size = int(min_target_size + (max_target_size - min_target_size) * coverage_ratio)
+
+    try:
+        pix = fitz.Pixmap(pdf_document, xref)
+        if pix.colorspace is None or pix.colorspace.n > 3:
+            # Stencil masks and CMYK first normalize to RGB
+            pix = fitz.Pixmap(fitz.csRGB, pix)
+
+        largest = max(pix.width, pix.height)
+        if largest > max_size:
+            # Each shrink step halves both dimensions
+            pix.shrink(max(1, math.ceil(math.log2(largest / max_size))))
+
+        if pix.alpha:
+            return pix.tobytes("png"), "image/png"
+        return pix.tobytes("jpeg", jpg_quality=85), "image/jpeg"
+    except Exception as e:
+        print(f"Pixmap render failed for xref {xref}: {e}")
+        return None
 
 def extract_images_from_page(page: fitz.Page, pdf_document: fitz.Document) -> List[Tuple]:
     """Extract images from a PDF page with metadata"""